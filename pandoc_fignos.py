@@ -42,15 +42,13 @@ __version__ = '2.4.0'
 
 import sys
 import re
-import functools
 import argparse
+import collections
+import itertools
 import json
-import copy
 import textwrap
-import uuid
 
-from pandocfilters import walk
-from pandocfilters import Image, Div
+from pandocfilters import Div
 from pandocfilters import Math, Str, Space, Para, RawBlock, RawInline
 from pandocfilters import Span
 
@@ -65,13 +63,29 @@ from pandocxnos import insert_secnos_factory, delete_secnos_factory
 from pandocxnos import version
 
 if sys.version_info > (3,):
-    from urllib.request import unquote
+    from urllib.parse import unquote
 else:
     from urllib import unquote  # pylint: disable=no-name-in-module
 
+# Use orjson for reading and writing the document if it is installed; it is
+# several times faster than the json module for large documents
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # Compiled regular expression for matching labels
 LABEL_PATTERN = re.compile(r'(fig:[\w/-]*)')
 
+# Compiled regular expressions for finding existing header-includes
+CLEVEREF_PATTERN = re.compile(r'\\usepackage(\[[\w\s,]*\])?\{cleveref\}')
+CAPTION_PATTERN = re.compile(r'\\usepackage(\[[\w\s,]*\])?\{caption\}')
+SECOFFSET_PATTERN = re.compile(r'\\setcounter\{section\}')
+
+# Output format families
+TEX_FORMATS = frozenset(['latex', 'beamer'])
+HTML_FORMATS = frozenset(['html', 'html4', 'html5', 'epub', 'epub2', 'epub3'])
+
 # Meta variables; may be reset elsewhere
 captionname = 'Figure'  # The caption name
 separator = 'colon'     # The caption separator
@@ -84,9 +98,10 @@ secoffset = 0           # Section number offset
 warninglevel = 2        # 0 - no warnings; 1 - some warnings; 2 - all warnings
 
 # Processing state variables
-cursec = None  # Current section
-Ntargets = 0   # Number of targets in current section (or document)
-targets = {}   # Global targets tracker
+state = {'cursec': None,  # Current section
+         'Ntargets': 0}   # Number of targets in current section (or document)
+targets = {}  # Global targets tracker
+unreferenceable_ids = itertools.count()  # Ids for unreferenceable figures
 
 # Processing flags
 captionname_changed = False     # Flags the caption name changed
@@ -98,6 +113,16 @@ has_tagged_figures = False      # Flags a tagged figure was found
 
 PANDOCVERSION = None
 
+# Caption separators
+SEPARATORS = {'none':'', 'colon':':', 'period':'.', 'space':' ',
+              'quad':u'\u2000', 'newline':'\n'}
+
+# Constant caption elements.  These are shared between captions and so must
+# never be modified.
+_SPAN_OPEN = RawInline('html', r'<span>')
+_SPAN_CLOSE = RawInline('html', r'</span>')
+_SPACE = Space()
+
 
 # Actions --------------------------------------------------------------------
 
@@ -128,58 +153,61 @@ def _extract_attrs(x, n):
         raise
 
 
-def _process_figure(key, value, fmt):
-    """Processes a figure.  Returns a dict containing figure properties.
+# Type for figure properties
+Figure = collections.namedtuple('Figure', ['is_unnumbered',
+                                           'is_unreferenceable', 'is_tagged',
+                                           'attrs', 'caption', 'num'])
+Figure.__new__.__defaults__ = (False, False, False, None, None, None)
+
+def _process_figure(key, value, fmt, st):
+    """Processes a figure.  Returns a Figure containing figure properties.
 
     Parameters:
 
       key - 'Para' (for a normal figure) or 'Div'
       value - the content of the figure
       fmt - the output format ('tex', 'html', ...)
+      st - the processing state dict; updated in place
     """
 
     # pylint: disable=global-statement
-    global cursec    # Current section being processed
-    global Ntargets  # Number of targets in current section (or document)
     global has_unnumbered_figures  # Flags that unnumbered figures were found
 
-    # Initialize the return value
-    fig = {'is_unnumbered': False,
-           'is_unreferenceable': False,
-           'is_tagged': False}
-
     # Bail out if there are no attributes
     if key == 'Para' and len(value[0]['c']) == 2:
         has_unnumbered_figures = True
-        fig.update({'is_unnumbered': True, 'is_unreferenceable': True})
-        return fig
+        return Figure(is_unnumbered=True, is_unreferenceable=True)
 
     # Parse the figure
-    attrs = fig['attrs'] = \
-      PandocAttributes(value[0]['c'][0] if key == 'Para' else value[0],
-                       'pandoc')
-    fig['caption'] = value[0]['c'][1] if key == 'Para' else None
+    attrs = PandocAttributes(value[0]['c'][0] if key == 'Para' else value[0],
+                             'pandoc')
+    caption = value[0]['c'][1] if key == 'Para' else None
 
     # Bail out if the label does not conform to expectations
     if not LABEL_PATTERN.match(attrs.id):
         has_unnumbered_figures = True
-        fig.update({'is_unnumbered': True, 'is_unreferenceable': True})
-        return fig
+        return Figure(is_unnumbered=True, is_unreferenceable=True,
+                      attrs=attrs, caption=caption)
 
     # Identify unreferenceable figures
-    if attrs.id == 'fig:':
-        attrs.id += str(uuid.uuid4())
-        fig['is_unreferenceable'] = True
+    is_unreferenceable = attrs.id == 'fig:'
+    if is_unreferenceable:
+        attrs.id = 'fig:__unref_%d__' % next(unreferenceable_ids)
+
+    # Get the tag, if there is one
+    tag = attrs['tag'] if 'tag' in attrs else None
 
     # Update the current section number
+    cursec, Ntargets = st['cursec'], st['Ntargets']
     if attrs['secno'] != cursec:  # The section number changed
-        cursec = attrs['secno']   # Update the global section tracker
+        cursec = st['cursec'] = attrs['secno']  # Update section tracker
         if numbersections:
-            Ntargets = 0          # Resets the global target counter
+            Ntargets = 0          # Resets the target counter
 
     # Increment the targets counter
-    if 'tag' not in attrs:
+    if tag is None:
         Ntargets += 1
+    st['Ntargets'] = Ntargets
 
     # Pandoc's --number-sections supports section numbering latex/pdf, html,
     # epub, and docx
@@ -187,68 +215,87 @@ def _process_figure(key, value, fmt):
         # Latex/pdf supports equation numbers by section natively.  For the
         # other formats we must hard-code in figure numbers by section as
         # tags.
-        if fmt in ['html', 'html4', 'html5', 'epub', 'epub2', 'epub3',
-                   'docx'] and \
-          'tag' not in attrs:
-            attrs['tag'] = str(cursec+secoffset) + '.' + str(Ntargets)
+        if (fmt in HTML_FORMATS or fmt == 'docx') and tag is None:
+            tag = attrs['tag'] = '%s.%s' % (cursec+secoffset, Ntargets)
 
     # Update the global targets tracker
-    fig['is_tagged'] = 'tag' in attrs
-    if fig['is_tagged']:  # ... then save the tag
+    is_tagged = tag is not None
+    if is_tagged:  # ... then save the tag
         # Remove any surrounding quotes
-        if attrs['tag'][0] == '"' and attrs['tag'][-1] == '"':
-            attrs['tag'] = attrs['tag'].strip('"')
-        elif attrs['tag'][0] == "'" and attrs['tag'][-1] == "'":
-            attrs['tag'] = attrs['tag'].strip("'")
-        targets[attrs.id] = pandocxnos.Target(attrs['tag'], cursec,
-                                              attrs.id in targets)
+        if tag[:1] in ('"', "'") and tag[-1:] == tag[:1]:
+            tag = attrs['tag'] = tag[1:-1]
+        num = tag
     else:  # ... then save the figure number
-        targets[attrs.id] = pandocxnos.Target(Ntargets, cursec,
-                                              attrs.id in targets)
-
-    return fig
+        num = Ntargets
+    targets[attrs.id] = pandocxnos.Target(num, cursec, attrs.id in targets)
+
+    return Figure(is_unreferenceable=is_unreferenceable, is_tagged=is_tagged,
+                  attrs=attrs, caption=caption, num=num)
+
+def _append_caption_number(els, fig):
+    """Appends the elements for the figure number (or tag) and separator
+    to the element list `els`."""
+    sep = SEPARATORS[separator]
+    num = fig.num
+    if isinstance(num, int):  # Numbered target
+        els.append(Str('%d%s' % (num, sep)))
+    elif num.startswith('$') and num.endswith('$'):  # Math tag
+        math = num.replace(' ', r'\ ')[1:-1]
+        els.append(Math({"t":"InlineMath", "c":[]}, math))
+        els.append(Str(sep))
+    else:  # Text tag
+        els.append(Str(num+sep))
+
+def _adjust_caption_plain(fig, value):
+    """Hard-codes the caption name and number/tag into the caption."""
+    if fig.is_unnumbered:
+        return
+    els = [Str(captionname+NBSP)]
+    _append_caption_number(els, fig)
+    els.append(_SPACE)
+    els.extend(fig.caption)
+    value[0]['c'][1] = els
+
+def _adjust_caption_html(fig, value):
+    """Hard-codes the caption name and number/tag into the caption, wrapped
+    in a span."""
+    if fig.is_unnumbered:
+        return
+    els = [_SPAN_OPEN, Str(captionname+NBSP)]
+    _append_caption_number(els, fig)
+    els.append(_SPAN_CLOSE)
+    els.append(_SPACE)
+    els.extend(fig.caption)
+    value[0]['c'][1] = els
+
+def _adjust_caption_tex(fig, value):
+    """Appends a \\label to the caption if the figure is referenceable,
+    then hard-codes the caption name and number/tag."""
+    if version(PANDOCVERSION) < version('1.17') and \
+      not fig.is_unreferenceable:
+        # pandoc >= 1.17 installs \label for us
+        value[0]['c'][1] += \
+          [RawInline('tex', r'\protect\label{%s}'%fig.attrs.id)]
+    _adjust_caption_plain(fig, value)
+
+def _adjust_caption_docx(fig, value):  # pylint: disable=unused-argument
+    """Leaves the caption as is; word generates the figure name/number."""
+
+# Caption adjustment functions by output format; other formats use
+# _adjust_caption_plain()
+_ADJUST_CAPTION = {'latex': _adjust_caption_tex,
+                   'beamer': _adjust_caption_tex,
+                   'html': _adjust_caption_html,
+                   'html4': _adjust_caption_html,
+                   'html5': _adjust_caption_html,
+                   'epub': _adjust_caption_html,
+                   'epub2': _adjust_caption_html,
+                   'epub3': _adjust_caption_html,
+                   'docx': _adjust_caption_docx}
 
 def _adjust_caption(fmt, fig, value):
     """Adjusts the caption."""
-    attrs, caption = fig['attrs'], fig['caption']
-    if fmt in ['latex', 'beamer']:  # Append a \label if this is referenceable
-        if version(PANDOCVERSION) < version('1.17') and \
-          not fig['is_unreferenceable']:
-            # pandoc >= 1.17 installs \label for us
-            value[0]['c'][1] += \
-              [RawInline('tex', r'\protect\label{%s}'%attrs.id)]
-    if fmt == 'docx':
-        # Do not need to generate a figure name/number for word
-        pass
-    else:  # Hard-code in the caption name and number/tag
-        if fig['is_unnumbered']:
-            return
-        sep = {'none':'', 'colon':':', 'period':'.', 'space':' ',
-               'quad':u'\u2000', 'newline':'\n'}[separator]
-
-        num = targets[attrs.id].num
-        if isinstance(num, int):  # Numbered target
-            if fmt in ['html', 'html4', 'html5', 'epub', 'epub2', 'epub3']:
-                value[0]['c'][1] = [RawInline('html', r'<span>'),
-                                    Str(captionname+NBSP),
-                                    Str('%d%s' % (num, sep)),
-                                    RawInline('html', r'</span>')]
-            else:
-                value[0]['c'][1] = [Str(captionname+NBSP),
-                                    Str('%d%s' % (num, sep))]
-        else:  # Tagged target
-            if num.startswith('$') and num.endswith('$'):  # Math
-                math = num.replace(' ', r'\ ')[1:-1]
-                els = [Math({"t":"InlineMath", "c":[]}, math), Str(sep)]
-            else:  # Text
-                els = [Str(num+sep)]
-            if fmt in ['html', 'html4', 'html5', 'epub', 'epub2', 'epub3']:
-                value[0]['c'][1] = \
-                  [RawInline('html', r'<span>'), Str(captionname+NBSP)] + \
-                  els + [RawInline('html', r'</span>')]
-            else:
-                value[0]['c'][1] = [Str(captionname+NBSP)] + els
-        value[0]['c'][1] += [Space()] + list(caption)
+    _ADJUST_CAPTION.get(fmt, _adjust_caption_plain)(fig, value)
 
 def _add_markup(fmt, fig, value):
     """Adds markup to the output."""
@@ -256,52 +303,197 @@ def _add_markup(fmt, fig, value):
     # pylint: disable=global-statement
     global has_tagged_figures  # Flags a tagged figure was found
 
-    if fig['is_unnumbered']:
-        if fmt in ['latex', 'beamer']:
+    if fig.is_unnumbered:
+        if fmt in TEX_FORMATS:
             # Use the no-prefix-figure-caption environment
             return [RawBlock('tex', r'\begin{fignos:no-prefix-figure-caption}'),
                     Para(value),
                     RawBlock('tex', r'\end{fignos:no-prefix-figure-caption}')]
         return None  # Nothing to do
 
-    attrs = fig['attrs']
+    attrs = fig.attrs
     ret = None
 
-    if fmt in ['latex', 'beamer']:
-        if fig['is_tagged']:  # A figure cannot be tagged if it is unnumbered
+    if fmt in TEX_FORMATS:
+        if fig.is_tagged:  # A figure cannot be tagged if it is unnumbered
             # Use the tagged-figure environment
             has_tagged_figures = True
             ret = [RawBlock('tex', r'\begin{fignos:tagged-figure}[%s]' % \
-                            str(targets[attrs.id].num)),
+                            str(fig.num)),
                    Para(value),
                    RawBlock('tex', r'\end{fignos:tagged-figure}')]
-    elif fmt in ('html', 'html4', 'html5', 'epub', 'epub2', 'epub3'):
-        if LABEL_PATTERN.match(attrs.id):
-            pre = RawBlock('html', '<div id="%s" class="fignos">'%attrs.id)
-            post = RawBlock('html', '</div>')
-            ret = [pre, Para(value), post]
-            # Eliminate the id from the Image
-            attrs.id = ''
-            value[0]['c'][0] = attrs.list
+    elif fmt in HTML_FORMATS:
+        # Numbered figures always have a conforming label
+        pre = RawBlock('html', '<div id="%s" class="fignos">'%attrs.id)
+        post = RawBlock('html', '</div>')
+        ret = [pre, Para(value), post]
+        # Eliminate the id from the Image
+        attrs.id = ''
+        value[0]['c'][0] = attrs.list
     return ret
 
-def process_figures(key, value, fmt, meta):  # pylint: disable=unused-argument
-    """Processes the figures."""
-
-    # Process figures wrapped in Para elements
-    if key == 'Para' and len(value) == 1 and \
-      value[0]['t'] == 'Image' and value[0]['c'][-1][1].startswith('fig:'):
-
-        # Process the figure and add markup
-        fig = _process_figure(key, value, fmt)
-        if 'attrs' in fig:
-            _adjust_caption(fmt, fig, value)
-        return _add_markup(fmt, fig, value)
-
-    if key == 'Div' and LABEL_PATTERN.match(value[0][0]):
-        fig = _process_figure(key, value, fmt)
-
-    return None
+def _is_figure_para(value):
+    """Returns True if the Para content `value` is a figure."""
+    return len(value) == 1 and value[0]['t'] == 'Image' and \
+      value[0]['c'][-1][1].startswith('fig:')
+
+def _process_para_figure(value, fmt):
+    """Processes a figure wrapped in a Para element.  Returns the replacement
+    elements, if any."""
+    # Process the figure and add markup
+    fig = _process_figure('Para', value, fmt, state)
+    if fig.attrs is not None:
+        _adjust_caption(fmt, fig, value)
+    return _add_markup(fmt, fig, value)
+
+def _process_div_figure(value, fmt):
+    """Processes a figure wrapped in a Div element."""
+    if LABEL_PATTERN.match(value[0][0]):
+        _process_figure('Div', value, fmt, state)
+
+
+# Traversals -----------------------------------------------------------------
+
+# Each pass over the document applies several actions.  Walking the tree once
+# per action (as pandocfilters.walk() does) rebuilds every list and dict in
+# the AST each time.  Instead, the actions for a pass are applied together in
+# a single traversal that modifies the element lists in place.  The
+# traversals use an explicit stack of [list, index, replaced] frames rather
+# than recursion.  Elements are visited in document order.
+
+def _push_lists(stack, x, replaced=False):
+    """Pushes frames for the lists found in `x` onto the `stack`.  The
+    frames are pushed in reverse so that they are popped in document
+    order."""
+    if isinstance(x, list):
+        stack.append([x, 0, replaced])
+    elif isinstance(x, dict):
+        for v in reversed(list(x.values())):
+            if isinstance(v, (list, dict)):
+                _push_lists(stack, v, replaced)
+
+# pylint: disable=too-many-arguments
+def first_pass_factory(attach_attrs_image, insert_secnos_img,
+                       insert_secnos_div, delete_secnos_img, delete_secnos_div,
+                       detach_attrs_image):
+    """Returns first_pass(x, fmt, meta) that attaches image attributes and
+    processes the figures in `x` in a single traversal."""
+
+    # Each visitor applies the actions to the content `value` of an element
+    # of a given type.  A visitor returns None or replacement element(s).
+
+    def _visit_header(value, fmt, meta):
+        """Tracks the section number."""
+        insert_secnos_img('Header', value, fmt, meta)
+
+    def _visit_plain(value, fmt, meta):
+        """Attaches image attributes."""
+        attach_attrs_image('Plain', value, fmt, meta)
+
+    def _visit_para(value, fmt, meta):
+        """Attaches image attributes and processes figures."""
+        attach_attrs_image('Para', value, fmt, meta)
+        if _is_figure_para(value):
+            # The section number is needed by the figure's image before
+            # its Para is processed
+            image = value[0]
+            insert_secnos_img('Image', image['c'], fmt, meta)
+            ret = _process_para_figure(value, fmt)
+            delete_secnos_img('Image', image['c'], fmt, meta)
+            return ret
+        return None
+
+    def _visit_div(value, fmt, meta):
+        """Processes figures."""
+        insert_secnos_div('Div', value, fmt, meta)
+        _process_div_figure(value, fmt)
+        delete_secnos_div('Div', value, fmt, meta)
+
+    def _visit_image(value, fmt, meta):
+        """Detaches image attributes."""
+        detach_attrs_image('Image', value, fmt, meta)
+
+    visitors = {'Header': _visit_header, 'Plain': _visit_plain,
+                'Para': _visit_para, 'Div': _visit_div,
+                'Image': _visit_image}
+
+    def first_pass(x, fmt, meta):
+        """Walks `x`, processing the figures.  Lists are modified in place."""
+        stack = []
+        _push_lists(stack, x)
+        while stack:
+            frame = stack[-1]
+            lst, i = frame[0], frame[1]
+            if i == len(lst):  # Done with this list
+                stack.pop()
+                continue
+            item = lst[i]
+            visit = visitors.get(item.get('t')) \
+              if isinstance(item, dict) else None
+            ret = visit(item.get('c'), fmt, meta) if visit else None
+            if ret is None:
+                frame[1] = i + 1
+                _push_lists(stack, item)
+            else:  # Splice in the replacement and walk its contents
+                ret = ret if isinstance(ret, list) else [ret]
+                lst[i:i+1] = ret
+                frame[1] = i + len(ret)
+                for el in reversed(ret):
+                    _push_lists(stack, el)
+
+    return first_pass
+
+# Elements whose content may hold references that need processing (see
+# pandocxnos.repair_refs() and process_refs_factory())
+_REF_CONTAINERS = frozenset(['Para', 'Plain', 'Emph', 'Strong', 'Span',
+                             'Header', 'Image', 'Table', 'Cite'])
+
+def second_pass_factory(process_refs, replace_refs, attach_attrs_span):
+    """Returns second_pass(x, fmt, meta) that processes and replaces the
+    references in `x` in a single traversal."""
+
+    def second_pass(x, fmt, meta):
+        """Walks `x`, replacing the references.  Lists are modified in place.
+        References in replacement content were already processed, and so
+        are only replaced."""
+        stack = []
+        _push_lists(stack, x)
+        while stack:
+            frame = stack[-1]
+            if isinstance(frame, tuple):  # Children are done; attach attrs
+                stack.pop()
+                attach_attrs_span(frame[0], frame[1], fmt, meta)
+                continue
+            lst, i, replaced = frame
+            if i == len(lst):  # Done with this list
+                stack.pop()
+                continue
+            item = lst[i]
+            if not (isinstance(item, dict) and 't' in item):
+                frame[1] = i + 1
+                _push_lists(stack, item, replaced)
+                continue
+            key, value = item['t'], item.get('c')
+            if not replaced and key in _REF_CONTAINERS:
+                repair_refs(key, value, fmt, meta)
+                process_refs(key, value, fmt, meta)
+            ret = replace_refs(key, value, fmt, meta) if key == 'Cite' \
+              else None
+            if ret is None:
+                frame[1] = i + 1
+                if key in ('Para', 'Plain'):
+                    # Attributes are attached to spans once the references
+                    # in the element are replaced
+                    stack.append((key, value))
+                _push_lists(stack, item, replaced)
+            else:  # Splice in the replacement and walk its contents
+                ret = ret if isinstance(ret, list) else [ret]
+                lst[i:i+1] = ret
+                frame[1] = i + len(ret)
+                for el in reversed(ret):
+                    _push_lists(stack, el, True)
+
+    return second_pass
 
 
 # TeX blocks -----------------------------------------------------------------
@@ -464,7 +656,7 @@ def process(meta):
 
     if 'fignos-plus-name' in meta:
         tmp = get_meta(meta, 'fignos-plus-name')
-        old_plusname = copy.deepcopy(plusname)
+        old_plusname = plusname[:]
         if isinstance(tmp, list):  # The singular and plural forms were given
             plusname = tmp
         else:  # Only the singular form was given
@@ -478,7 +670,7 @@ def process(meta):
 
     if 'fignos-star-name' in meta:
         tmp = get_meta(meta, 'fignos-star-name')
-        old_starname = copy.deepcopy(starname)
+        old_starname = starname[:]
         if isinstance(tmp, list):
             starname = tmp
         else:
@@ -499,9 +691,11 @@ def process(meta):
 def add_tex(meta):
     """Adds tex to the meta data."""
 
+    needs_cleveref = pandocxnos.cleveref_required()
+
     # pylint: disable=too-many-boolean-expressions
     warnings = warninglevel == 2 and targets and \
-      (pandocxnos.cleveref_required() or has_unnumbered_figures or
+      (needs_cleveref or has_unnumbered_figures or
        plusname_changed or starname_changed or has_tagged_figures or
        captionname_changed or numbersections or secoffset)
     if warnings:
@@ -520,13 +714,13 @@ def add_tex(meta):
     # is a known issue and is owing to a design decision in pandoc.
     # See https://github.com/jgm/pandoc/issues/3139.
 
-    if pandocxnos.cleveref_required() and targets:
+    if needs_cleveref and targets:
         tex = """
             %%%% pandoc-fignos: required package
             \\usepackage%s{cleveref}
         """ % ('[capitalise]' if capitalise else '')
         pandocxnos.add_to_header_includes(
-            meta, 'tex', tex, regex=r'\\usepackage(\[[\w\s,]*\])?\{cleveref\}')
+            meta, 'tex', tex, regex=CLEVEREF_PATTERN)
 
     if has_unnumbered_figures or (separator_changed and targets):
         tex = """
@@ -534,7 +728,7 @@ def add_tex(meta):
             \\usepackage{caption}
         """
         pandocxnos.add_to_header_includes(
-            meta, 'tex', tex, regex=r'\\usepackage(\[[\w\s,]*\])?\{caption\}')
+            meta, 'tex', tex, regex=CAPTION_PATTERN)
 
     if plusname_changed and targets:
         tex = """
@@ -571,39 +765,63 @@ def add_tex(meta):
     if secoffset and targets:
         pandocxnos.add_to_header_includes(
             meta, 'tex', SECOFFSET_TEX % secoffset,
-            regex=r'\\setcounter\{section\}')
+            regex=SECOFFSET_PATTERN)
 
     if warnings:
         STDERR.write('\n')
 
-# pylint: disable=too-many-locals, unused-argument
-def main(stdin=STDIN, stdout=STDOUT, stderr=STDERR):
-    """Filters the document AST."""
+def reset():
+    """Resets the meta variables, processing state and flags to their
+    defaults so that another document may be processed."""
 
     # pylint: disable=global-statement
-    global PANDOCVERSION
-    global Image
+    global captionname, separator, cleveref, capitalise, plusname, starname
+    global numbersections, secoffset, warninglevel
+    global state, targets, unreferenceable_ids
+    global captionname_changed, separator_changed, plusname_changed
+    global starname_changed, has_unnumbered_figures, has_tagged_figures
+
+    # Meta variables
+    captionname = 'Figure'
+    separator = 'colon'
+    cleveref = False
+    capitalise = False
+    plusname = ['fig.', 'figs.']
+    starname = ['Figure', 'Figures']
+    numbersections = False
+    secoffset = 0
+    warninglevel = 2
+    pandocxnos.set_warning_level(warninglevel)
+
+    # Processing state variables
+    state = {'cursec': None, 'Ntargets': 0}
+    targets = {}
+    unreferenceable_ids = itertools.count()
+    del pandocxnos.badlabels[:]  # Bad reference warnings are issued once
+
+    # Processing flags
+    captionname_changed = False
+    separator_changed = False
+    plusname_changed = False
+    starname_changed = False
+    has_unnumbered_figures = False
+    has_tagged_figures = False
+
+# pylint: disable=too-many-locals
+def process_doc(doc, fmt, pandocversion=None, has_figures=True):
+    """Processes the document AST `doc` for the output format `fmt` and
+    returns the result.  The first pass is skipped if `has_figures` is
+    False."""
 
-    # Read the command-line arguments
-    parser = argparse.ArgumentParser(\
-      description='Pandoc figure numbers filter.')
-    parser.add_argument(\
-      '--version', action='version',
-      version='%(prog)s {version}'.format(version=__version__))
-    parser.add_argument('fmt')
-    parser.add_argument('--pandocversion', help='The pandoc version.')
-    args = parser.parse_args()
-
-    # Get the output format and document
-    fmt = args.fmt
-    doc = json.loads(stdin.read())
+    # pylint: disable=global-statement
+    global PANDOCVERSION
 
     # Initialize pandocxnos
-    PANDOCVERSION = pandocxnos.init(args.pandocversion, doc)
+    PANDOCVERSION = pandocxnos.init(pandocversion, doc)
 
     # Element primitives
-    if version(PANDOCVERSION) < version('1.16'):
-        Image = elt('Image', 2)
+    Image = elt('Image', 2) if version(PANDOCVERSION) < version('1.16') \
+      else elt('Image', 3)
 
     # Chop up the doc
     meta = doc['meta'] if version(PANDOCVERSION) >= version('1.18') \
@@ -614,22 +832,22 @@ def main(stdin=STDIN, stdout=STDOUT, stderr=STDERR):
     # Process the metadata variables
     process(meta)
 
-    # First pass
-    replace = version(PANDOCVERSION) >= version('1.16')
-    attach_attrs_image = attach_attrs_factory(Image,
-                                              extract_attrs=_extract_attrs,
-                                              replace=replace)
-    detach_attrs_image = detach_attrs_factory(Image)
-    insert_secnos_img = insert_secnos_factory(Image)
-    delete_secnos_img = delete_secnos_factory(Image)
-    insert_secnos_div = insert_secnos_factory(Div)
-    delete_secnos_div = delete_secnos_factory(Div)
-    altered = functools.reduce(lambda x, action: walk(x, action, fmt, meta),
-                               [attach_attrs_image,
-                                insert_secnos_img, insert_secnos_div,
-                                process_figures,
-                                delete_secnos_img, delete_secnos_div,
-                                detach_attrs_image], blocks)
+    # First pass; skipped if there are no figures
+    if has_figures:
+        replace = version(PANDOCVERSION) >= version('1.16')
+        attach_attrs_image = attach_attrs_factory(Image,
+                                                  extract_attrs=_extract_attrs,
+                                                  replace=replace)
+        detach_attrs_image = detach_attrs_factory(Image)
+        insert_secnos_img = insert_secnos_factory(Image)
+        delete_secnos_img = delete_secnos_factory(Image)
+        insert_secnos_div = insert_secnos_factory(Div)
+        delete_secnos_div = delete_secnos_factory(Div)
+        first_pass = first_pass_factory(attach_attrs_image,
+                                        insert_secnos_img, insert_secnos_div,
+                                        delete_secnos_img, delete_secnos_div,
+                                        detach_attrs_image)
+        first_pass(blocks, fmt, meta)
 
     # Second pass
     process_refs = process_refs_factory(LABEL_PATTERN, targets.keys())
@@ -639,25 +857,72 @@ def main(stdin=STDIN, stdout=STDOUT, stderr=STDERR):
                                         [name.title() for name in plusname],
                                         starname)
     attach_attrs_span = attach_attrs_factory(Span, replace=True)
-    altered = functools.reduce(lambda x, action: walk(x, action, fmt, meta),
-                               [repair_refs, process_refs, replace_refs,
-                                attach_attrs_span],
-                               altered)
+    second_pass = second_pass_factory(process_refs, replace_refs,
+                                      attach_attrs_span)
+    second_pass(blocks, fmt, meta)
 
-    if fmt in ['latex', 'beamer']:
+    if fmt in TEX_FORMATS:
         add_tex(meta)
 
     # Update the doc
     if version(PANDOCVERSION) >= version('1.18'):
-        doc['blocks'] = altered
+        doc['blocks'] = blocks
+    else:
+        doc = doc[:1] + blocks
+
+    return doc
+
+def _filter(text, fmt, pandocversion, stdout):
+    """Filters the document in the json `text` and writes it to `stdout`."""
+
+    if orjson:
+        doc = orjson.loads(text)  # pylint: disable=no-member
     else:
-        doc = doc[:1] + altered
+        doc = json.loads(text)
+
+    # Figures are only found in documents with images or fig: labels.  This
+    # is a fast path for batch pipelines that convert many small documents.
+    has_figures = '"Image"' in text or 'fig:' in text
+
+    doc = process_doc(doc, fmt, pandocversion, has_figures)
 
     # Dump the results
-    json.dump(doc, stdout)
+    if orjson:
+        out = orjson.dumps(doc).decode('utf-8')  # pylint: disable=no-member
+        stdout.write(out)
+    else:
+        json.dump(doc, stdout)
+
+# pylint: disable=unused-argument
+def main(stdin=STDIN, stdout=STDOUT, stderr=STDERR):
+    """Filters the document AST."""
+
+    # Read the command-line arguments
+    parser = argparse.ArgumentParser(\
+      description='Pandoc figure numbers filter.')
+    parser.add_argument(\
+      '--version', action='version',
+      version='%(prog)s {version}'.format(version=__version__))
+    parser.add_argument('fmt')
+    parser.add_argument('--pandocversion', help='The pandoc version.')
+    parser.add_argument(\
+      '--batch', action='store_true',
+      help='Filter newline-delimited json documents until end of input.')
+    args = parser.parse_args()
+
+    if args.batch:  # Filter one document per line
+        for line in stdin:
+            if not line.strip():
+                continue
+            reset()
+            _filter(line, args.fmt, args.pandocversion, stdout)
+            stdout.write('\n')
+            stdout.flush()
+    else:
+        _filter(stdin.read(), args.fmt, args.pandocversion, stdout)
 
-    # Flush stdout
-    stdout.flush()
+        # Flush stdout
+        stdout.flush()
 
 if __name__ == '__main__':
     main()
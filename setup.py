@@ -49,6 +49,7 @@ setup(
                  __version__,
 
     install_requires=['pandoc-xnos >= 2.5.0, < 3.0'],
+    extras_require={'fast': ['orjson']},
 
     py_modules=['pandoc_fignos'],
     entry_points={'console_scripts':['pandoc-fignos = pandoc_fignos:main']},